@@ -1,23 +1,53 @@
 """Functions to perform event detection."""
 import subprocess
+from functools import reduce
 from os.path import basename, join
 
 import numpy as np
 from joblib import Parallel, delayed
 from nilearn.input_data import NiftiLabelsMasker
-from scipy.stats import zscore
+from scipy import sparse
 
 import atlas_mod
 from Debiasing.debiasing_functions import debiasing_block, debiasing_spike
 from Debiasing.hrf_matrix import HRFMatrix
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def zscore_ts(data):
+    """
+    Z-score time series (ddof=1) in single precision, setting NaNs to zero.
+
+    Matches np.nan_to_num(zscore(data, ddof=1)) up to float32 rounding, but
+    normalizes a single float32 copy in place. Mean and standard deviation are
+    accumulated in double precision.
+    """
+    data = np.array(data, dtype=np.float32, copy=True)
+    m = data.mean(axis=0, dtype=np.float64).astype(np.float32)
+    np.subtract(data, m, out=data)
+
+    # standard deviation of the demeaned data, without a full-size temporary
+    ss = np.einsum("ti,ti->i", data, data, dtype=np.float64)
+    s = np.sqrt(ss / (data.shape[0] - 1)).astype(np.float32)
+
+    np.divide(data, s, out=data, where=s != 0)
+    # constant time series have zero std and are set to zero as well
+    data[:, s == 0] = 0
+    np.nan_to_num(data, copy=False)
+
+    return data
+
 
 def calculate_ets(y, n):
     """
     Calculate edge-time series.
     """
     # upper triangle indices (node pairs = edges)
-    u, v = np.argwhere(np.triu(np.ones(n), 1)).T
+    u, v = np.triu_indices(n, k=1)
 
     # edge time series
     ets = y[:, u] * y[:, v]
@@ -25,32 +55,118 @@ def calculate_ets(y, n):
     return ets, u, v
 
 
-def rss_surr(z_ts, u, v, surrprefix, sursufix, masker, irand):
+def rss_from_ts(y):
+    """
+    Calculate RSS of the edge-time series directly from the node time series.
+
+    Uses sum_{u<v} (y_u * y_v)^2 = ((sum y^2)^2 - sum y^4) / 2, so the edge-time
+    series never has to be built.
+    """
+    # accumulate in double precision; the subtraction below is ill-conditioned
+    s2 = np.einsum("ti,ti->t", y, y, dtype=np.float64)
+    s4 = np.einsum("ti,ti,ti,ti->t", y, y, y, y, dtype=np.float64)
+
+    # clip round-off so that the square root stays real
+    return np.sqrt(np.maximum((s2**2 - s4) / 2, 0))
+
+
+def ets_range(y):
+    """
+    Calculate minimum and maximum of the edge-time series without building it.
+
+    For each time-point the extreme products of node pairs are found among the
+    two smallest and two largest values.
+    """
+    ys = np.sort(y, axis=1)
+    lo_lo = ys[:, 0] * ys[:, 1]
+    hi_hi = ys[:, -1] * ys[:, -2]
+    lo_hi = ys[:, 0] * ys[:, -1]
+
+    ets_min = np.min(np.minimum(np.minimum(lo_lo, hi_hi), lo_hi))
+    ets_max = np.max(np.maximum(lo_lo, hi_hi))
+
+    return ets_min, ets_max
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _circshift_rss_numba(z_ts, shifts):
+        """
+        Fused circular shift, ETS and RSS kernel.
+        """
+        t, n = z_ts.shape
+        rss = np.empty(t)
+        for i in numba.prange(t):
+            s2 = 0.0
+            s4 = 0.0
+            for j in range(n):
+                val = z_ts[(i - shifts[j] + t) % t, j]
+                val2 = val * val
+                s2 += val2
+                s4 += val2 * val2
+            rss[i] = np.sqrt(max((s2 * s2 - s4) / 2, 0.0))
+
+        return rss
+
+
+def _circshift_rss(z_ts, shifts):
+    """
+    Calculate RSS of the time series with every column circularly shifted by
+    the given amount.
+
+    Uses a single fused numba kernel when numba is available, and a NumPy
+    gather otherwise. Both accumulate in double precision, so the null
+    distribution does not depend on whether numba is installed.
+    """
+    if numba is not None:
+        return _circshift_rss_numba(z_ts, shifts)
+
+    [t, n] = z_ts.shape
+    rows = (np.arange(t)[:, None] - shifts[None, :]) % t
+    zr = z_ts[rows, np.arange(n)[None, :]]
+
+    return rss_from_ts(zr)
+
+
+def rss_surr(z_ts, surrprefix, sursufix, masker, irand, keep_ts=False):
     """
     Calculate RSS on surrogate data.
+
+    The masker must already be fitted; surrogates are only transformed. If
+    keep_ts is True, the surrogate time series is returned as well so that it
+    does not have to be read again.
     """
     [t, n] = z_ts.shape
 
     if surrprefix != "":
-        zr = masker.fit_transform(f"{surrprefix}{irand}{sursufix}.nii.gz")
+        zr = masker.transform(f"{surrprefix}{irand}{sursufix}.nii.gz")
         if "AUC" not in surrprefix:
-            zr = np.nan_to_num(zscore(zr, ddof=1))
+            zr = zscore_ts(zr)
 
         # TODO: find out why surrogates of AUC have NaNs after reading data with masker.
-        zr = np.nan_to_num(zr)
-    else:
-        # perform numrand randomizations
-        zr = np.copy(z_ts)
-        for i in range(n):
-            zr[:, i] = np.roll(zr[:, i], np.random.randint(t))
+        zr = np.nan_to_num(zr).astype(np.float32, copy=False)
 
-    # edge time series with circshift data
-    etsr = zr[:, u] * zr[:, v]
+        # calcuate rss without building the edge time series
+        rssr = rss_from_ts(zr)
 
-    # calcuate rss
-    rssr = np.sqrt(np.sum(np.square(etsr), axis=1))
+        # the ets range is only needed for the histogram of AUC surrogates
+        if "AUC" in surrprefix:
+            etsr_min, etsr_max = ets_range(zr)
+        else:
+            etsr_min, etsr_max = np.inf, -np.inf
+    else:
+        # perform numrand randomizations: circularly shift every column by a
+        # random amount
+        rng = np.random.default_rng()
+        shifts = rng.integers(0, t, size=n)
+        rssr = _circshift_rss(z_ts, shifts)
+
+        # the ets range is only needed for AUC surrogates, which are read from file
+        zr = None
+        etsr_min, etsr_max = np.inf, -np.inf
 
-    return (rssr, np.min(etsr), np.max(etsr))
+    return (irand, rssr, etsr_min, etsr_max, zr if keep_ts else None)
 
 
 def event_detection(DATA_file, atlas, surrprefix="", sursufix="", segments=True):
@@ -64,88 +180,93 @@ def event_detection(DATA_file, atlas, surrprefix="", sursufix="", segments=True)
         strategy="mean",
     )
 
+    # fit the masker once; surrogates reuse it with transform()
     data = masker.fit_transform(DATA_file)
     # load and zscore time series
     # AUC does not get z-scored
+    # single precision halves memory traffic of the ets/rss computations
     if "AUC" in surrprefix:
-        z_ts = data
+        z_ts = data.astype(np.float32, copy=False)
     else:
-        z_ts = np.nan_to_num(zscore(data, ddof=1))
+        z_ts = zscore_ts(data)
     # Get number of time points/nodes
     [t, n] = z_ts.shape
 
     # calculate ets
     ets, u, v = calculate_ets(z_ts, n)
 
-    # calculate rss
-    rss = np.sqrt(np.sum(np.square(ets), axis=1))
+    # calculate rss (accumulated in double precision, as the null rss)
+    rss = np.sqrt(np.einsum("ij,ij->i", ets, ets, dtype=np.float64))
 
     # repeat with randomized time series
     numrand = 100
-    # initialize array for null rss
-    rssr = np.zeros([t, numrand])
 
-    results = Parallel(n_jobs=-1, backend="multiprocessing")(
-        delayed(rss_surr)(z_ts, u, v, surrprefix, sursufix, masker, irand)
+    # initialize array for null rss
+    rssr = np.empty([t, numrand], dtype=np.float32)
+    hist_min = np.inf
+    hist_max = -np.inf
+    # AUC surrogates are kept in memory for the thresholding step
+    keep_ts = "AUC" in surrprefix
+    surrogates = [None] * numrand
+
+    # loky keeps a reusable pool of worker processes, and (with joblib's default
+    # max_nbytes) memory-maps z_ts instead of pickling it per task only when it
+    # is larger than 1 MB; results are written into their column as they arrive
+    results = Parallel(n_jobs=-1, backend="loky", return_as="generator_unordered")(
+        delayed(rss_surr)(z_ts, surrprefix, sursufix, masker, irand, keep_ts)
         for irand in range(numrand)
     )
 
-    for irand in range(numrand):
-        rssr[:, irand] = results[irand][0]
+    for irand, rssr_irand, etsr_min, etsr_max, zr in results:
+        rssr[:, irand] = rssr_irand
+        surrogates[irand] = zr
+        hist_min = min(hist_min, etsr_min)
+        hist_max = max(hist_max, etsr_max)
 
     # TODO: find out why there is such a big peak on time-point 0 for AUC surrogates
     if "AUC" in surrprefix:
         rssr[0, :] = 0
-        hist_ranges = np.zeros((2, numrand))
-        for irand in range(numrand):
-            hist_ranges[0, irand] = results[irand][1]
-            hist_ranges[1, irand] = results[irand][2]
-
-        hist_min = np.min(hist_ranges, axis=1)[0]
-        hist_max = np.max(hist_ranges, axis=1)[1]
-
-    p = np.zeros([t, 1])
-    rssr_flat = rssr.flatten()
-    for i in range(t):
-        p[i] = np.mean(rssr_flat >= rss[i])
+
+    # p-value: fraction of null rss values >= observed rss (sorted search)
+    rssr_sorted = np.sort(rssr, axis=None)
+    n_null = rssr_sorted.size
+    p = (n_null - np.searchsorted(rssr_sorted, rss, side="left")) / n_null
     # apply statistical cutoff
     pcrit = 0.001
 
     # find frames that pass statistical testz_ts
-    idx = np.argwhere(p < pcrit)[:, 0]
+    idx = np.flatnonzero(p < pcrit)
     if segments:
         # identify contiguous segments of frames that pass statistical test
-        dff = idx.T - range(len(idx))
-        unq = np.unique(dff)
-        nevents = len(unq)
-
-        # find the peak rss within each segment
-        idxpeak = np.zeros([nevents, 1])
-        for ievent in range(nevents):
-            idxevent = idx[dff.T == unq[ievent].T]
-            rssevent = rss[idxevent]
-            idxmax = np.argmax(rssevent)
-            idxpeak[ievent] = idxevent[idxmax]
-        idxpeak = idxpeak[:, 0].astype(int)
+        dff = idx - np.arange(len(idx))
+
+        # find the peak rss within each segment: sort by segment and then by
+        # descending rss, so the first frame of every segment is its peak
+        order = np.lexsort((-rss[idx], dff))
+        dff_sorted = dff[order]
+        boundaries = np.flatnonzero(np.diff(dff_sorted, prepend=dff_sorted[:1] - 1))
+        idxpeak = idx[order][boundaries]
     # get activity at peak
     else:
         idxpeak = idx
     tspeaks = z_ts[idxpeak, :]
 
-    # get co-fluctuation at peak
-    etspeaks = tspeaks[:, u] * tspeaks[:, v]
-    # calculate mean co-fluctuation (edge time series) across all peaks
-    mu = np.nanmean(etspeaks, 0)
+    # get co-fluctuation at peak (rows of the already computed ets)
+    etspeaks = ets[idxpeak, :]
+    # calculate mean co-fluctuation (edge time series) across all peaks from the
+    # node-by-node co-fluctuation matrix
+    if "AUC" in surrprefix:
+        # AUC is not passed through nan_to_num, so ignore NaNs as nanmean would
+        isvalid = ~np.isnan(tspeaks)
+        tspeaks_valid = np.where(isvalid, tspeaks, 0)
+        isvalid = isvalid.astype(float)
+        mu = (tspeaks_valid.T @ tspeaks_valid)[u, v] / (isvalid.T @ isvalid)[u, v]
+    else:
+        mu = (tspeaks.T @ tspeaks)[u, v] / tspeaks.shape[0]
 
     if "AUC" in surrprefix:
-        print("Reading AUC of surrogates to perform the thresholding step...")
-        ets_thr = surrogates_to_array(
-            surrprefix,
-            sursufix,
-            masker,
-            hist_range=(hist_min, hist_max),
-            numrand=numrand,
-        )
+        print("Using AUC of surrogates to perform the thresholding step...")
+        ets_thr = surrogates_to_array(surrogates, hist_range=(hist_min, hist_max))
         ets_thr = threshold_ets_matrix(ets, idxpeak, ets_thr)
     else:
         ets_thr = None
@@ -157,53 +278,63 @@ def threshold_ets_matrix(ets_matrix, selected_idxs, thr):
     """
     Threshold the edge time-series matrix based on the selected time-points and
     the surrogate matrices.
-    """
 
-    # Initialize matrix with zeros
-    thresholded_matrix = np.zeros(ets_matrix.shape)
+    Returns a sparse CSR matrix with the shape of the ETS matrix; only the
+    selected time-points above threshold are stored.
+    """
 
-    # Get selected columns from ETS matrix
-    thresholded_matrix[selected_idxs, :] = ets_matrix[selected_idxs, :]
+    # Get selected rows from ETS matrix
+    selected_matrix = ets_matrix[selected_idxs, :]
 
     # Threshold ETS matrix based on surrogate percentile
-    thresholded_matrix[thresholded_matrix < thr] = 0
+    selected_matrix = np.where(selected_matrix < thr, 0, selected_matrix)
+
+    # Place surviving values at their original time-points
+    rows, cols = np.nonzero(selected_matrix)
+    thresholded_matrix = sparse.csr_matrix(
+        (selected_matrix[rows, cols], (np.asarray(selected_idxs)[rows], cols)),
+        shape=ets_matrix.shape,
+    )
 
     return thresholded_matrix
 
 
-def calculate_hist(surrprefix, sursufix, irand, masker, hist_range, nbins=500):
+def calculate_hist(auc, hist_range, nbins=500):
     """
-    Calculate histogram.
+    Calculate histogram of the edge-time series of a surrogate AUC.
     """
-    auc = masker.fit_transform(f"{surrprefix}{irand}{sursufix}.nii.gz")
+    auc = np.nan_to_num(auc).astype(np.float32, copy=False)
     [t, n] = auc.shape
-    ets_temp, _, _ = calculate_ets(np.nan_to_num(auc), n)
+    u, v = np.triu_indices(n, k=1)
+
+    bin_edges = np.histogram_bin_edges([], bins=nbins, range=hist_range)
 
-    ets_hist, bin_edges = np.histogram(ets_temp.flatten(), bins=nbins, range=hist_range)
+    # accumulate the histogram one time-point at a time so the full edge-time
+    # series is never held in memory
+    ets_hist = np.zeros(nbins, dtype=np.int64)
+    for it in range(t):
+        ets_row = auc[it, u] * auc[it, v]
+        ets_hist += np.histogram(ets_row, bins=nbins, range=hist_range)[0]
 
     return (ets_hist, bin_edges)
 
 
-def surrogates_to_array(
-    surrprefix, sursufix, masker, hist_range, numrand=100, nbins=500, percentile=95
-):
+def surrogates_to_array(surrogates, hist_range, nbins=500, percentile=95):
     """
-    Read AUCs of surrogates, calculate histogram and sum of all histograms to
-    obtain a single histogram that summarizes the data.
+    Calculate histogram of the AUCs of surrogates (already read by
+    event_detection) and sum of all histograms to obtain a single histogram
+    that summarizes the data.
     """
-    ets_hist = np.zeros((numrand, nbins))
-
-    hist = Parallel(n_jobs=-1, backend="multiprocessing")(
-        delayed(calculate_hist)(surrprefix, sursufix, irand, masker, hist_range, nbins)
-        for irand in range(numrand)
+    # threads share the in-memory surrogates without pickling them to worker
+    # processes; the per-row numpy calls are small, so most of the GIL is held
+    # and the speed-up from threading here is limited
+    hist = Parallel(n_jobs=-1, backend="threading")(
+        delayed(calculate_hist)(auc, hist_range, nbins) for auc in surrogates
     )
 
-    for irand in range(numrand):
-        ets_hist[irand, :] = hist[irand][0]
-
     bin_edges = hist[0][1]
 
-    ets_hist_sum = np.sum(ets_hist, axis=0)
+    ets_hist_sum = reduce(np.add, (ets_hist for ets_hist, _ in hist))
     cumsum_percentile = np.cumsum(ets_hist_sum) / np.sum(ets_hist_sum) * 100
     thr = bin_edges[len(cumsum_percentile[cumsum_percentile <= percentile])]
 
@@ -227,14 +358,11 @@ def debiasing(data_file, mask, mtx, idx_u, idx_v, tr, out_dir, history_str):
 
     # Generate mask of significant edge-time connections
     ets_mask = np.zeros(data.shape)
-    idxs = np.where(mtx != 0)
-    time_idxs = idxs[0]
-    edge_idxs = idxs[1]
+    time_idxs, edge_idxs = mtx.nonzero()
 
     print("Generating mask of significant edge-time connections...")
-    for idx, time_idx in enumerate(time_idxs):
-        ets_mask[time_idx, idx_u[edge_idxs[idx]]] = 1
-        ets_mask[time_idx, idx_v[edge_idxs[idx]]] = 1
+    ets_mask[time_idxs, idx_u[edge_idxs]] = 1
+    ets_mask[time_idxs, idx_v[edge_idxs]] = 1
 
     # Create HRF matrix
     hrf = HRFMatrix(
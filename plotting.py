@@ -341,7 +341,7 @@ def main(argv=None):
 
     # Plot ETS and denoised ETS matrices of AUC
     plot_ets_matrix(ets_auc, MAINDIR, "_AUC_original", DVARS, ENORM, idxpeak_auc)
-    plot_ets_matrix(ets_auc_denoised, MAINDIR, "_AUC_denoised", DVARS, ENORM, idxpeak_auc)
+    plot_ets_matrix(ets_auc_denoised.toarray(), MAINDIR, "_AUC_denoised", DVARS, ENORM, idxpeak_auc)
 
     # Save RSS time-series as text file for easier visualization on AFNI
     rss_out = np.zeros(rss_auc.shape)